@@ -1,12 +1,21 @@
-from flask import Flask, render_template, request, jsonify, send_file
-from datetime import datetime, date
+from flask import Flask, render_template, request, jsonify, send_file, send_from_directory, make_response, g
+from datetime import datetime, date, timedelta, timezone
 from calendar import monthrange
 import os
 import io
 import csv
+import hashlib
+import json
+import math
+import re
+import zlib
+import threading
+import time
+from collections import OrderedDict
 from functools import wraps
 from pathlib import Path
 
+import click
 from dotenv import load_dotenv
 
 import firebase_admin
@@ -35,6 +44,128 @@ if not firebase_admin._apps:
 
 fs = firestore.client()
 
+# ==================== Rate Limit / Backpressure ====================
+
+# 1ユーザーあたりの予算（1分あたりの補充量とバースト上限）
+RATE_LIMIT_READ_PER_MIN = int(os.getenv("RATE_LIMIT_READ_PER_MIN", "120"))
+RATE_LIMIT_READ_BURST = int(os.getenv("RATE_LIMIT_READ_BURST", "30"))
+RATE_LIMIT_WRITE_PER_MIN = int(os.getenv("RATE_LIMIT_WRITE_PER_MIN", "30"))
+RATE_LIMIT_WRITE_BURST = int(os.getenv("RATE_LIMIT_WRITE_BURST", "10"))
+# プロセス全体で同時に処理するAPIリクエスト数の上限（0で無効）
+MAX_CONCURRENT_REQUESTS = int(os.getenv("MAX_CONCURRENT_REQUESTS", "32"))
+# 複数ワーカーで共有する場合は redis://... を指定（未指定ならプロセス内メモリ）
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "")
+
+class MemoryBucketStore:
+    """プロセス内メモリのトークンバケット（単一ワーカー向け）"""
+
+    def __init__(self, max_keys=10000):
+        # key -> (tokens, updated_at)。最後に使われた順に並べ、上限を超えたら最も古いものから捨てる
+        self._buckets = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_keys = max_keys
+
+    def take(self, key, rate, capacity):
+        """トークンを1つ消費する。戻り値は (許可されたか, 再試行までの秒数)"""
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated_at = self._buckets.pop(key, (capacity, now))
+            tokens = min(capacity, tokens + (now - updated_at) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                allowed, retry_after = True, 0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (1 - tokens) / rate
+            while len(self._buckets) > self._max_keys:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+class RedisBucketStore:
+    """Redis上のトークンバケット（複数ワーカーで共有）"""
+
+    _SCRIPT = """
+local tokens = tonumber(redis.call('HGET', KEYS[1], 't'))
+local updated = tonumber(redis.call('HGET', KEYS[1], 'u'))
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+if tokens == nil then
+  tokens = capacity
+  updated = now
+end
+tokens = math.min(capacity, tokens + (now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+  tokens = tokens - 1
+  allowed = 1
+end
+redis.call('HSET', KEYS[1], 't', tostring(tokens), 'u', tostring(now))
+redis.call('EXPIRE', KEYS[1], math.ceil(capacity / rate) + 1)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url, timeout=0.2):
+        import redis  # 共有ストアを使う場合のみ必要
+
+        # Redisが応答しない間にワーカーと同時実行枠を握り続けないよう短いタイムアウトにする
+        self._client = redis.Redis.from_url(url, socket_timeout=timeout, socket_connect_timeout=timeout)
+        self._take = self._client.register_script(self._SCRIPT)
+        self._redis_error = redis.RedisError
+        # Redis障害時はプロセス内メモリで制限を続ける
+        self._fallback = MemoryBucketStore()
+
+    def take(self, key, rate, capacity):
+        try:
+            allowed, tokens = self._take(keys=[f"ratelimit:{key}"], args=[rate, capacity, time.time()])
+        except self._redis_error as e:
+            app.logger.warning("[RateLimit] Redis unavailable, falling back to in-memory store: %s", e)
+            return self._fallback.take(key, rate, capacity)
+        if int(allowed):
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+rate_limit_store = RedisBucketStore(RATE_LIMIT_REDIS_URL) if RATE_LIMIT_REDIS_URL else MemoryBucketStore()
+_request_slots = threading.BoundedSemaphore(MAX_CONCURRENT_REQUESTS) if MAX_CONCURRENT_REQUESTS > 0 else None
+
+def _take_rate_limit_token(uid: str, kind: str):
+    """kind は "read" / "write"。戻り値は (許可されたか, 再試行までの秒数)"""
+    if kind == "read":
+        per_min, burst = RATE_LIMIT_READ_PER_MIN, RATE_LIMIT_READ_BURST
+    else:
+        per_min, burst = RATE_LIMIT_WRITE_PER_MIN, RATE_LIMIT_WRITE_BURST
+    if per_min <= 0:
+        return True, 0
+    return rate_limit_store.take(f"{uid}:{kind}", per_min / 60.0, burst)
+
+def _check_rate_limit(uid: str):
+    """予算超過なら429レスポンスを返す。許可されればNone"""
+    kind = "read" if request.method in ("GET", "HEAD") else "write"
+    allowed, retry_after = _take_rate_limit_token(uid, kind)
+    if allowed:
+        return None
+
+    resp = jsonify({"error": "リクエストが多すぎます。しばらく待ってから再試行してください"})
+    resp.headers["Retry-After"] = str(max(1, math.ceil(retry_after)))
+    return resp, 429
+
+@app.before_request
+def _acquire_request_slot():
+    # トークン検証やFirestore呼び出しの前に、混雑時は即座に負荷を落とす
+    if _request_slots is None or not request.path.startswith("/api/"):
+        return None
+    if not _request_slots.acquire(blocking=False):
+        resp = jsonify({"error": "サーバーが混雑しています。しばらく待ってから再試行してください"})
+        resp.headers["Retry-After"] = "1"
+        return resp, 503
+    g.request_slot_acquired = True
+    return None
+
+@app.teardown_request
+def _release_request_slot(_exc):
+    if g.pop("request_slot_acquired", False):
+        _request_slots.release()
+
 # ==================== Auth Decorator ====================
 
 def require_firebase_auth(fn):
@@ -51,6 +182,10 @@ def require_firebase_auth(fn):
             return jsonify({"error": "Invalid token"}), 401
 
         request.firebase_uid = decoded["uid"]
+
+        limited = _check_rate_limit(request.firebase_uid)
+        if limited is not None:
+            return limited
         return fn(*args, **kwargs)
     return wrapper
 
@@ -82,50 +217,347 @@ def _doc_to_task(doc):
         "duration_seconds": int(d.get("duration_seconds") or 0),
     }
 
-# ==================== 画面表示 ====================
+# ==================== Idempotency-Key ====================
 
-@app.route("/")
-def index():
-    return render_template("index.html")
+# オフライン時にキューされた操作の再送で重複作成しないよう、結果をキーごとに保存する
+IDEMPOTENCY_KEY_RE = re.compile(r"^[A-Za-z0-9_-]{8,128}$")
+IDEMPOTENCY_TTL = timedelta(days=7)
+# 処理中の記録はこの時間を過ぎると再送で引き継げる（ワーカーが途中で落ちた場合の取り残し対策）
+IDEMPOTENCY_LEASE = timedelta(seconds=30)
+# 端末の時計のずれとして許容する幅
+CLIENT_TIME_SKEW = timedelta(minutes=5)
 
-# ==================== API ====================
+def idempotency_ref(uid: str):
+    # users/{uid}/idempotency_keys/{key}（expires_at に Firestore の TTL ポリシーを設定する想定）
+    return fs.collection("users").document(uid).collection("idempotency_keys")
 
-@app.route("/api/task/add", methods=["POST"])
-@require_firebase_auth
-def api_add_task():
-    uid = request.firebase_uid
-    data = request.get_json() or {}
+def _load_idempotent_result(uid: str, key: str):
+    doc = idempotency_ref(uid).document(key).get()
+    if not doc.exists:
+        return None
+    return doc.to_dict() or None
+
+@firestore.transactional
+def _claim_idempotency_key(transaction, rec_ref, scope):
+    """キーを処理中として確保する。確保できればNone、処理済み・処理中なら既存の記録を返す"""
+    snap = rec_ref.get(transaction=transaction)
+    rec = (snap.to_dict() or {}) if snap.exists else None
+    now = datetime.now(timezone.utc)
+    if rec is not None and (rec.get("status") == "done" or rec.get("locked_until", now) > now):
+        return rec
+
+    transaction.set(rec_ref, {
+        "status": "pending",
+        "scope": scope,
+        "locked_until": now + IDEMPOTENCY_LEASE,
+        "expires_at": now + IDEMPOTENCY_TTL,
+    })
+    return None
+
+def _commit_with_result(batch, rec_ref, body, status):
+    """成功結果を Idempotency-Key の記録と同じバッチで書き込む（書き込みと記録が必ず揃う）"""
+    if rec_ref is not None:
+        batch.update(rec_ref, {"status": "done", "status_code": status, "body": body})
+    batch.commit()
+    return body, status
+
+def _run_idempotent(uid: str, key, scope: str, action):
+    """同じキーの再送には保存済みの結果を返す。戻り値は (body, status, 再送かどうか)
+
+    action(rec_ref) は成功時に _commit_with_result で結果を記録する。
+    """
+    if not key:
+        body, status = action(None)
+        return body, status, False
+    if not isinstance(key, str) or not IDEMPOTENCY_KEY_RE.match(key):
+        return {"error": "Idempotency-Keyの形式が不正です"}, 400, False
+
+    rec_ref = idempotency_ref(uid).document(key)
+    rec = _claim_idempotency_key(fs.transaction(), rec_ref, scope)
+    if rec is not None:
+        if rec.get("status") != "done":
+            return {"error": "同じIdempotency-Keyのリクエストを処理中です"}, 409, False
+        if rec.get("scope") != scope:
+            return {"error": "Idempotency-Keyが別の操作で使用済みです"}, 422, False
+        return rec.get("body"), rec.get("status_code", 200), True
+
+    # 例外時は書き込みが確定したか分からないため確保は消さず、リースの期限切れで再送に引き継ぐ
+    body, status = action(rec_ref)
+    if status >= 500:
+        # サーバー側の失敗は再送で再実行できるようにする
+        rec_ref.delete()
+    elif status >= 400:
+        # 書き込みを伴わない失敗はここで記録する
+        rec_ref.update({"status": "done", "status_code": status, "body": body})
+    return body, status, False
+
+def _idempotent_response(uid: str, scope: str, action):
+    body, status, replayed = _run_idempotent(uid, request.headers.get("Idempotency-Key"), scope, action)
+    resp = make_response(jsonify(body), status)
+    if replayed:
+        resp.headers["Idempotent-Replayed"] = "true"
+    return resp
+
+def _parse_client_time(value, not_before=None):
+    """オフライン中に記録された操作時刻（ISO8601）をUTCのdatetimeに変換する
+
+    IDEMPOTENCY_TTL より古い時刻や not_before より前の時刻は ValueError。
+    時計のずれ程度の誤差は not_before と現在時刻の範囲に丸める。
+    """
+    if value is None or value == "":
+        return None
+    if not isinstance(value, str):
+        raise ValueError("not a string")
+    dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    dt = dt.astimezone(timezone.utc)
+
+    now = datetime.now(timezone.utc)
+    if dt < now - IDEMPOTENCY_TTL:
+        raise ValueError("too old")
+    if not_before is not None:
+        if dt < not_before - CLIENT_TIME_SKEW:
+            raise ValueError("before not_before")
+        dt = max(dt, not_before)
+    return min(dt, now)
+
+# ==================== 月次スナップショット（締め済み月のアーカイブ） ====================
+
+# 締め済みの月は users/{uid}/month_snapshots/{YYYY-MM} に1ドキュメントとして圧縮保存する
+SNAPSHOT_FIELDS = [
+    "id", "task_name", "category", "memo", "created_date",
+    "created_at", "start_time", "end_time", "duration_seconds",
+]
+# Firestoreの1ドキュメント上限(1MiB)に余裕を持たせる
+SNAPSHOT_MAX_BYTES = 900 * 1024
+
+def snapshots_ref(uid: str):
+    # users/{uid}/month_snapshots/{YYYY-MM}
+    return fs.collection("users").document(uid).collection("month_snapshots")
+
+def _month_range(year: int, month: int):
+    _, last_day = monthrange(year, month)
+    return f"{year}-{month:02d}-01", f"{year}-{month:02d}-{last_day}"
+
+def _is_closed_month(year: int, month: int):
+    today = date.today()
+    return (year, month) < (today.year, today.month)
+
+def _aggregate_tasks(tasks, group_field):
+    grouped = {}
+    total_seconds = 0
+    total_tasks = 0
+    unique_days = set()
+
+    for r in tasks:
+        total_tasks += 1
+        unique_days.add(r.get("created_date"))
+        sec = int(r.get("duration_seconds") or 0)
+        total_seconds += sec
 
+        key = r.get(group_field) or "(未設定)"
+        if key not in grouped:
+            grouped[key] = {"name": key, "task_count": 0, "total_seconds": 0}
+        grouped[key]["task_count"] += 1
+        grouped[key]["total_seconds"] += sec
+
+    data = []
+    for v in grouped.values():
+        v["total_hours"] = round(v["total_seconds"] / 3600.0, 1)  # 小数第1位に変更
+        data.append(v)
+    data.sort(key=lambda x: x["total_seconds"], reverse=True)
+
+    totals = {
+        "total_days": len(unique_days),
+        "total_tasks": total_tasks,
+        "total_seconds": total_seconds,
+        "total_hours": round(total_seconds / 3600.0, 1),  # 小数第1位に変更
+    }
+    return data, totals
+
+def _pack_tasks(tasks):
+    rows = [[t.get(f) for f in SNAPSHOT_FIELDS] for t in tasks]
+    raw = json.dumps(rows, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    return zlib.compress(raw, 9)
+
+def _unpack_tasks(blob):
+    rows = json.loads(zlib.decompress(blob).decode("utf-8"))
+    return [dict(zip(SNAPSHOT_FIELDS, row)) for row in rows]
+
+def _load_month_snapshot(uid: str, year: int, month: int):
+    if not _is_closed_month(year, month):
+        return None
+    month_id = f"{year}-{month:02d}"
+    snap_ref = snapshots_ref(uid).document(month_id)
+    version_ref = month_versions_ref(uid).document(month_id)
+
+    # スナップショットと月の version を1往復で読み、凍結後に編集があれば使わない
+    docs = {d.reference.path: d for d in fs.get_all([snap_ref, version_ref])}
+    snap_doc, version_doc = docs.get(snap_ref.path), docs.get(version_ref.path)
+    if snap_doc is None or not snap_doc.exists:
+        return None
+    snap = snap_doc.to_dict() or {}
+    version = int(((version_doc.to_dict() or {}) if version_doc and version_doc.exists else {}).get("version") or 0)
+    if snap.get("version") != version:
+        return None
+    return snap or None
+
+def _query_month_tasks(uid: str, year: int, month: int):
+    start_date, end_date = _month_range(year, month)
+    # インデックス不要にするため order_by を削除
+    q = (tasks_ref(uid)
+         .where("created_date", ">=", start_date)
+         .where("created_date", "<=", end_date))
+    return [_doc_to_task(d) for d in q.stream()]
+
+def _load_month_tasks(uid: str, year: int, month: int):
+    """指定月のタスク一覧を返す。締め済み月はスナップショットから1回の読み取りで返す"""
+    snap = _load_month_snapshot(uid, year, month)
+    if snap is not None:
+        return _unpack_tasks(snap["tasks"])
+    return _query_month_tasks(uid, year, month)
+
+def _monthly_aggregates(uid: str, year: int, month: int, group_field: str):
+    # 締め済み月は事前集計済みのスナップショットをそのまま返す
+    snap = _load_month_snapshot(uid, year, month)
+    if snap is not None:
+        agg = snap["aggregates"][group_field]
+        return agg["data"], agg["totals"]
+    return _aggregate_tasks(_query_month_tasks(uid, year, month), group_field)
+
+def month_versions_ref(uid: str):
+    # users/{uid}/month_versions/{YYYY-MM}（その月のタスクが書き込まれるたびに version を進める）
+    return fs.collection("users").document(uid).collection("month_versions")
+
+def _read_month_version(version_ref, transaction=None):
+    doc = version_ref.get(transaction=transaction)
+    if not doc.exists:
+        return 0
+    return int((doc.to_dict() or {}).get("version") or 0)
+
+def compact_month(uid: str, year: int, month: int):
+    """締め済みの月を1つのスナップショットに凍結する。凍結したタスク数を返す"""
+    if not _is_closed_month(year, month):
+        raise ValueError(f"{year}-{month:02d} はまだ締められていません")
+
+    month_id = f"{year}-{month:02d}"
+    version_ref = month_versions_ref(uid).document(month_id)
+    version = _read_month_version(version_ref)
+
+    tasks = _query_month_tasks(uid, year, month)
+    if not tasks:
+        return 0
+
+    aggregates = {}
+    for group_field in ("category", "task_name"):
+        data, totals = _aggregate_tasks(tasks, group_field)
+        aggregates[group_field] = {"data": data, "totals": totals}
+
+    # ドキュメント全体（圧縮済みタスク + 集計結果）で上限を確認する
+    packed = _pack_tasks(tasks)
+    size = len(packed) + len(json.dumps(aggregates, ensure_ascii=False).encode("utf-8"))
+    if size > SNAPSHOT_MAX_BYTES:
+        raise ValueError(f"{month_id} のスナップショットが大きすぎます ({size} bytes)")
+
+    @firestore.transactional
+    def _commit(transaction):
+        # 集計中に編集があれば version が進んでいるので凍結しない
+        if _read_month_version(version_ref, transaction) != version:
+            raise ValueError(f"{month_id} は集計中に編集されたため凍結を中止しました")
+        transaction.set(snapshots_ref(uid).document(month_id), {
+            "year": year,
+            "month": month,
+            "version": version,
+            "task_count": len(tasks),
+            "tasks": packed,
+            "aggregates": aggregates,
+            "frozen_at": firestore.SERVER_TIMESTAMP,
+        })
+
+    _commit(fs.transaction())
+    return len(tasks)
+
+def _mark_month_edited(batch, uid: str, created_date):
+    """タスクの書き込みと同じバッチで月の version を進め、締め済み月ならスナップショットを破棄する"""
+    try:
+        d = datetime.strptime(created_date or "", "%Y-%m-%d")
+    except (TypeError, ValueError):
+        return
+    month_id = f"{d.year}-{d.month:02d}"
+    batch.set(month_versions_ref(uid).document(month_id), {
+        "version": firestore.Increment(1),
+        "updated_at": firestore.SERVER_TIMESTAMP,
+    }, merge=True)
+    if _is_closed_month(d.year, d.month):
+        batch.delete(snapshots_ref(uid).document(month_id))
+
+@app.cli.command("compact-months")
+@click.option("--year", type=int, help="対象年（省略時は先月）")
+@click.option("--month", type=int, help="対象月（省略時は先月）")
+@click.option("--uid", help="対象ユーザー（省略時は全ユーザー）")
+def compact_months_command(year, month, uid):
+    """締め済みの月をユーザーごとのスナップショットに凍結する"""
+    if year is None or month is None:
+        today = date.today()
+        year, month = (today.year, today.month - 1) if today.month > 1 else (today.year - 1, 12)
+
+    uids = [uid] if uid else [d.id for d in fs.collection("users").list_documents()]
+    for u in uids:
+        try:
+            count = compact_month(u, year, month)
+        except ValueError as e:
+            click.echo(f"[skip] {u}: {e}")
+            continue
+        except Exception as e:
+            # 1ユーザーの失敗で残りのユーザーを止めない
+            click.echo(f"[error] {u}: {e}", err=True)
+            continue
+        click.echo(f"[ok] {u}: {year}-{month:02d} ({count} tasks)")
+
+# ==================== タスク操作 ====================
+# ルートと /api/batch の両方から呼ぶ。戻り値は (レスポンスbody, ステータス)
+# rec_ref は Idempotency-Key の記録（キーなしなら None）。成功結果はタスクの書き込みと同じバッチで記録する
+
+def _add_task(uid: str, data: dict, rec_ref=None):
     task_name = data.get("task_name")
     category = data.get("category")
     memo = data.get("memo", "")
     created_date = data.get("created_date")  # optional "YYYY-MM-DD"
 
     if not task_name or not category:
-        return jsonify({"error": "task_nameとcategoryは必須です"}), 400
+        return {"error": "task_nameとcategoryは必須です"}, 400
 
     if created_date:
         try:
             datetime.strptime(created_date, "%Y-%m-%d")
-        except ValueError:
-            return jsonify({"error": "created_date形式が不正です (YYYY-MM-DD)"}), 400
+        except (TypeError, ValueError):
+            return {"error": "created_date形式が不正です (YYYY-MM-DD)"}, 400
     else:
         created_date = date.today().isoformat()
 
+    # オフライン中に追加されたタスクは端末での追加時刻を created_at にする
+    try:
+        created_at = _parse_client_time(data.get("at"))
+    except ValueError:
+        return {"error": "atの形式が不正、または範囲外です (ISO8601)"}, 400
+
     doc_ref = tasks_ref(uid).document()  # 自動docId
     payload = {
         "task_name": task_name,
         "category": category,
         "memo": memo,
         "created_date": created_date,
-        "created_at": firestore.SERVER_TIMESTAMP,
+        "created_at": created_at or firestore.SERVER_TIMESTAMP,
         "start_time": None,
         "end_time": None,
         "duration_seconds": 0,
     }
-    doc_ref.set(payload)
+    batch = fs.batch()
+    batch.set(doc_ref, payload)
+    _mark_month_edited(batch, uid, created_date)
 
-    return jsonify({
+    return _commit_with_result(batch, rec_ref, {
         "success": True,
         "task": {
             "id": doc_ref.id,
@@ -133,12 +565,153 @@ def api_add_task():
             "category": category,
             "memo": memo,
             "created_date": created_date,
-            "created_at": None,
+            "created_at": _to_iso(created_at),
             "start_time": None,
             "end_time": None,
             "duration_seconds": 0,
         }
-    }), 201
+    }, 201)
+
+def _start_task(uid: str, task_id, data: dict, rec_ref=None):
+    if not task_id:
+        return {"error": "task_idは必須です"}, 400
+
+    doc_ref = tasks_ref(uid).document(task_id)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return {"error": "タスクが見つかりません"}, 404
+
+    d = doc.to_dict() or {}
+    if d.get("start_time") is not None:
+        return {"error": "タスクは既に開始されています"}, 400
+
+    try:
+        started_at = _parse_client_time(data.get("at"), not_before=d.get("created_at"))
+    except ValueError:
+        return {"error": "atの形式が不正、または範囲外です (ISO8601)"}, 400
+
+    # 記録するレスポンスを書き込み前に確定させるため、開始時刻はサーバー側で決める
+    started_at = started_at or datetime.now(timezone.utc)
+    batch = fs.batch()
+    batch.update(doc_ref, {"start_time": started_at})
+    _mark_month_edited(batch, uid, d.get("created_date"))
+    task = {**_doc_to_task(doc), "start_time": _to_iso(started_at)}
+    return _commit_with_result(batch, rec_ref, {"success": True, "task": task}, 200)
+
+def _stop_task(uid: str, task_id, data: dict, rec_ref=None):
+    if not task_id:
+        return {"error": "task_idは必須です"}, 400
+
+    doc_ref = tasks_ref(uid).document(task_id)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return {"error": "タスクが見つかりません"}, 404
+
+    d = doc.to_dict() or {}
+    start_time = d.get("start_time")
+    end_time = d.get("end_time")
+
+    if start_time is None:
+        return {"error": "タスクが開始されていません"}, 400
+    if end_time is not None:
+        return {"error": "タスクは既に停止されています"}, 400
+
+    # Timestamp -> datetime
+    start_dt = start_time.to_datetime() if hasattr(start_time, "to_datetime") else start_time
+    try:
+        stopped_at = _parse_client_time(data.get("at"), not_before=start_dt)
+    except ValueError:
+        return {"error": "atの形式が不正、または範囲外です (ISO8601)"}, 400
+
+    stopped_at = stopped_at or datetime.now(timezone.utc)
+    duration_seconds = int((stopped_at.replace(tzinfo=None) - start_dt.replace(tzinfo=None)).total_seconds())
+    if duration_seconds < 0:
+        duration_seconds = 0
+
+    batch = fs.batch()
+    batch.update(doc_ref, {
+        "end_time": stopped_at,
+        "duration_seconds": duration_seconds,
+    })
+    _mark_month_edited(batch, uid, d.get("created_date"))
+    task = {**_doc_to_task(doc), "end_time": _to_iso(stopped_at), "duration_seconds": duration_seconds}
+    return _commit_with_result(batch, rec_ref, {"success": True, "task": task}, 200)
+
+def _update_task(uid: str, task_id, data: dict, rec_ref=None):
+    task_name = data.get("task_name")
+    category = data.get("category")
+    memo = data.get("memo", "")
+
+    if not task_name or not category:
+        return {"error": "task_nameとcategoryは必須です"}, 400
+
+    doc_ref = tasks_ref(uid).document(task_id)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return {"error": "タスクが見つかりません"}, 404
+
+    batch = fs.batch()
+    batch.update(doc_ref, {
+        "task_name": task_name,
+        "category": category,
+        "memo": memo,
+    })
+    _mark_month_edited(batch, uid, (doc.to_dict() or {}).get("created_date"))
+    task = {**_doc_to_task(doc), "task_name": task_name, "category": category, "memo": memo}
+    return _commit_with_result(batch, rec_ref, {"success": True, "task": task}, 200)
+
+def _delete_task(uid: str, task_id, data: dict, rec_ref=None):
+    doc_ref = tasks_ref(uid).document(task_id)
+    doc = doc_ref.get()
+    if not doc.exists:
+        return {"error": "タスクが見つかりません"}, 404
+
+    batch = fs.batch()
+    batch.delete(doc_ref)
+    _mark_month_edited(batch, uid, (doc.to_dict() or {}).get("created_date"))
+    return _commit_with_result(batch, rec_ref, {"success": True, "message": "タスクを削除しました"}, 200)
+
+# op -> 操作関数。Idempotency-Key の scope は "{op}:{task_id}"
+TASK_OPERATIONS = {
+    "add": lambda uid, task_id, data, rec_ref=None: _add_task(uid, data, rec_ref),
+    "start": _start_task,
+    "stop": _stop_task,
+    "update": _update_task,
+    "delete": _delete_task,
+}
+
+def _task_op_response(op: str, task_id=None):
+    uid = request.firebase_uid
+    data = request.get_json(silent=True) or {}
+    if not isinstance(data, dict):
+        return jsonify({"error": "リクエストボディが不正です"}), 400
+    if task_id is None and op != "add":
+        task_id = data.get("task_id")  # Firestore docId（文字列）
+    if task_id is not None and not isinstance(task_id, str):
+        return jsonify({"error": "task_idが不正です"}), 400
+
+    action = lambda rec_ref: TASK_OPERATIONS[op](uid, task_id, data, rec_ref)
+    return _idempotent_response(uid, f"{op}:{task_id or ''}", action)
+
+# ==================== 画面表示 ====================
+
+@app.route("/")
+def index():
+    return render_template("index.html")
+
+@app.route("/sw.js")
+def service_worker():
+    # スコープを "/" にするためルートから配信する
+    resp = send_from_directory(app.static_folder, "sw.js", mimetype="application/javascript")
+    resp.headers["Cache-Control"] = "no-cache"
+    return resp
+
+# ==================== API ====================
+
+@app.route("/api/task/add", methods=["POST"])
+@require_firebase_auth
+def api_add_task():
+    return _task_op_response("add")
 
 @app.route("/api/tasks/date")
 @require_firebase_auth
@@ -182,101 +755,89 @@ def api_tasks_today():
 @app.route("/api/task/start", methods=["POST"])
 @require_firebase_auth
 def api_task_start():
-    uid = request.firebase_uid
-    data = request.get_json() or {}
-    task_id = data.get("task_id")  # Firestore docId（文字列）
-
-    if not task_id:
-        return jsonify({"error": "task_idは必須です"}), 400
-
-    doc_ref = tasks_ref(uid).document(task_id)
-    doc = doc_ref.get()
-    if not doc.exists:
-        return jsonify({"error": "タスクが見つかりません"}), 404
-
-    d = doc.to_dict() or {}
-    if d.get("start_time") is not None:
-        return jsonify({"error": "タスクは既に開始されています"}), 400
-
-    doc_ref.update({"start_time": firestore.SERVER_TIMESTAMP})
-    doc2 = doc_ref.get()
-    return jsonify({"success": True, "task": _doc_to_task(doc2)}), 200
+    return _task_op_response("start")
 
 @app.route("/api/task/stop", methods=["POST"])
 @require_firebase_auth
 def api_task_stop():
-    uid = request.firebase_uid
-    data = request.get_json() or {}
-    task_id = data.get("task_id")
-
-    if not task_id:
-        return jsonify({"error": "task_idは必須です"}), 400
-
-    doc_ref = tasks_ref(uid).document(task_id)
-    doc = doc_ref.get()
-    if not doc.exists:
-        return jsonify({"error": "タスクが見つかりません"}), 404
-
-    d = doc.to_dict() or {}
-    start_time = d.get("start_time")
-    end_time = d.get("end_time")
-
-    if start_time is None:
-        return jsonify({"error": "タスクが開始されていません"}), 400
-    if end_time is not None:
-        return jsonify({"error": "タスクは既に停止されています"}), 400
-
-    # Timestamp -> datetime
-    start_dt = start_time.to_datetime() if hasattr(start_time, "to_datetime") else start_time
-    now_dt = datetime.utcnow()
-    duration_seconds = int((now_dt - start_dt.replace(tzinfo=None)).total_seconds())
-    if duration_seconds < 0:
-        duration_seconds = 0
-
-    doc_ref.update({
-        "end_time": firestore.SERVER_TIMESTAMP,
-        "duration_seconds": duration_seconds,
-    })
-    doc2 = doc_ref.get()
-    return jsonify({"success": True, "task": _doc_to_task(doc2)}), 200
+    return _task_op_response("stop")
 
 @app.route("/api/task/update/<task_id>", methods=["POST"])
 @require_firebase_auth
 def api_task_update(task_id):
-    uid = request.firebase_uid
-    data = request.get_json() or {}
-
-    task_name = data.get("task_name")
-    category = data.get("category")
-    memo = data.get("memo", "")
-
-    if not task_name or not category:
-        return jsonify({"error": "task_nameとcategoryは必須です"}), 400
-
-    doc_ref = tasks_ref(uid).document(task_id)
-    doc = doc_ref.get()
-    if not doc.exists:
-        return jsonify({"error": "タスクが見つかりません"}), 404
-
-    doc_ref.update({
-        "task_name": task_name,
-        "category": category,
-        "memo": memo,
-    })
-    doc2 = doc_ref.get()
-    return jsonify({"success": True, "task": _doc_to_task(doc2)}), 200
+    return _task_op_response("update", task_id)
 
 @app.route("/api/task/delete/<task_id>", methods=["POST"])
 @require_firebase_auth
 def api_task_delete(task_id):
-    uid = request.firebase_uid
-    doc_ref = tasks_ref(uid).document(task_id)
-    doc = doc_ref.get()
-    if not doc.exists:
-        return jsonify({"error": "タスクが見つかりません"}), 404
+    return _task_op_response("delete", task_id)
+
+# オフラインキューの一括再送用
+BATCH_MAX_OPERATIONS = 50
 
-    doc_ref.delete()
-    return jsonify({"success": True, "message": "タスクを削除しました"}), 200
+@app.route("/api/batch", methods=["POST"])
+@require_firebase_auth
+def api_batch():
+    uid = request.firebase_uid
+    data = request.get_json(silent=True) or {}
+    operations = data.get("operations") if isinstance(data, dict) else None
+
+    if not isinstance(operations, list) or not operations:
+        return jsonify({"error": "operationsは必須です"}), 400
+    if len(operations) > BATCH_MAX_OPERATIONS:
+        return jsonify({"error": f"operationsは{BATCH_MAX_OPERATIONS}件以内で指定してください"}), 400
+
+    # 同じバッチ内で追加したタスクは task_ref（追加時のIdempotency-Key）で参照できる
+    created_ids = {}
+    results = []
+    for i, op in enumerate(operations):
+        # 1件目はこのリクエスト自体の書き込み予算で処理済み。2件目以降も1件ずつ消費する
+        if i > 0:
+            allowed, retry_after = _take_rate_limit_token(uid, "write")
+            if not allowed:
+                # 残りは結果に含めない（クライアントは Retry-After 後に再送する）
+                results.append({
+                    "idempotency_key": op.get("idempotency_key") if isinstance(op, dict) else None,
+                    "status": 429,
+                    "body": {"error": "リクエストが多すぎます", "retry_after": max(1, math.ceil(retry_after))},
+                })
+                break
+
+        op = op if isinstance(op, dict) else {}
+        key = op.get("idempotency_key")
+        body = op.get("data") or {}
+        task_id = op.get("task_id")
+        task_ref = op.get("task_ref")
+        result = {"idempotency_key": key}
+        results.append(result)
+
+        if (op.get("op") not in TASK_OPERATIONS
+                or not isinstance(key, str) or not IDEMPOTENCY_KEY_RE.match(key)
+                or not isinstance(body, dict)
+                or not isinstance(task_id, (str, type(None)))
+                or not isinstance(task_ref, (str, type(None)))):
+            result.update(status=400, body={"error": "操作の形式が不正です"})
+            continue
+
+        if op["op"] != "add" and not task_id:
+            if not task_ref:
+                result.update(status=400, body={"error": "task_idまたはtask_refは必須です"})
+                continue
+            task_id = created_ids.get(task_ref)
+            if task_id is None and IDEMPOTENCY_KEY_RE.match(task_ref):
+                rec = _load_idempotent_result(uid, task_ref) or {}
+                task_id = ((rec.get("body") or {}).get("task") or {}).get("id")
+            if task_id is None:
+                result.update(status=404, body={"error": "参照先のタスクが見つかりません"})
+                continue
+
+        action = lambda rec_ref: TASK_OPERATIONS[op["op"]](uid, task_id, body, rec_ref)
+        res_body, status, _ = _run_idempotent(uid, key, f"{op['op']}:{task_id or ''}", action)
+        result.update(status=status, body=res_body)
+        if op["op"] == "add" and status < 300:
+            created_ids[key] = ((res_body or {}).get("task") or {}).get("id")
+
+    return jsonify({"success": True, "results": results}), 200
 
 @app.route("/api/report/monthly", methods=["GET"])
 @require_firebase_auth
@@ -291,47 +852,7 @@ def api_report_monthly():
         return jsonify({"error": "月は1-12の範囲で指定してください"}), 400
 
     group_field = "category" if group_by == "category" else "task_name"
-
-    start_date = f"{year}-{month:02d}-01"
-    _, last_day = monthrange(year, month)
-    end_date = f"{year}-{month:02d}-{last_day}"
-
-    q = (tasks_ref(uid)
-         .where("created_date", ">=", start_date)
-         .where("created_date", "<=", end_date))
-
-    docs = list(q.stream())
-    rows = [d.to_dict() or {} for d in docs]
-
-    grouped = {}
-    total_seconds = 0
-    total_tasks = 0
-    unique_days = set()
-
-    for r in rows:
-        total_tasks += 1
-        unique_days.add(r.get("created_date"))
-        sec = int(r.get("duration_seconds") or 0)
-        total_seconds += sec
-
-        key = r.get(group_field) or "(未設定)"
-        if key not in grouped:
-            grouped[key] = {"name": key, "task_count": 0, "total_seconds": 0}
-        grouped[key]["task_count"] += 1
-        grouped[key]["total_seconds"] += sec
-
-    data = []
-    for v in grouped.values():
-        v["total_hours"] = round(v["total_seconds"] / 3600.0, 1)  # 小数第1位に変更
-        data.append(v)
-    data.sort(key=lambda x: x["total_seconds"], reverse=True)
-
-    totals = {
-        "total_days": len(unique_days),
-        "total_tasks": total_tasks,
-        "total_seconds": total_seconds,
-        "total_hours": round(total_seconds / 3600.0, 1),  # 小数第1位に変更
-    }
+    data, totals = _monthly_aggregates(uid, year, month, group_field)
 
     return jsonify({
         "success": True,
@@ -350,17 +871,10 @@ def api_export_csv():
     year = request.args.get("year", type=int) or datetime.now().year
     month = request.args.get("month", type=int) or datetime.now().month
 
-    start_date = f"{year}-{month:02d}-01"
-    _, last_day = monthrange(year, month)
-    end_date = f"{year}-{month:02d}-{last_day}"
-
-    # インデックス不要にするため order_by を削除
-    q = (tasks_ref(uid)
-         .where("created_date", ">=", start_date)
-         .where("created_date", "<=", end_date))
+    if not (1 <= month <= 12):
+        return jsonify({"error": "月は1-12の範囲で指定してください"}), 400
 
-    docs = list(q.stream())
-    tasks = [_doc_to_task(d) for d in docs]
+    tasks = _load_month_tasks(uid, year, month)
     # Python側でソート（created_dateの昇順）
     tasks.sort(key=lambda x: x.get("created_date") or "")
 
@@ -395,6 +909,86 @@ def api_export_csv():
         download_name=f"tasks_{year}_{month:02d}.csv",
     )
 
+# ==================== 印刷用月次レポート ====================
+
+# .env の REPORT_CACHE_DIR=./report_cache を想定
+report_cache_env = os.getenv("REPORT_CACHE_DIR", "./report_cache")
+REPORT_CACHE_DIR = (APP_DIR / report_cache_env).resolve() if report_cache_env.startswith("./") else Path(report_cache_env).expanduser().resolve()
+REPORT_TEMPLATE = "report_print.html"
+
+def _report_content_version(uid: str, year: int, month: int):
+    """月の version（month_versions）とテンプレートから版数を作る。タスクが変わらなければ同じ値になる"""
+    month_version = _read_month_version(month_versions_ref(uid).document(f"{year}-{month:02d}"))
+    template_mtime = os.path.getmtime(Path(app.root_path) / app.template_folder / REPORT_TEMPLATE)
+    raw = f"{month_version}:{template_mtime}"
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()[:32]
+
+def _render_report(report: dict, fmt: str):
+    html = render_template(REPORT_TEMPLATE, **report)
+    if fmt == "html":
+        return html.encode("utf-8")
+    from weasyprint import HTML  # PDF出力を使う場合のみ必要
+
+    return HTML(string=html, base_url=str(APP_DIR)).write_pdf()
+
+def _cached_report(uid: str, year: int, month: int, group_by: str, fmt: str):
+    """版数が同じならディスク上のキャッシュを返し、変わっていれば集計・再生成して差し替える"""
+    # 版数は集計より先に読む（集計中に編集されても次回は版数が進んでいるので再生成される）
+    version = _report_content_version(uid, year, month)
+    owner = hashlib.sha256(uid.encode("utf-8")).hexdigest()[:16]
+    prefix = f"{owner}_{year}-{month:02d}_{group_by}"
+    path = REPORT_CACHE_DIR / f"{prefix}_{version}.{fmt}"
+
+    if path.exists():
+        return path.read_bytes(), version
+
+    group_field = "category" if group_by == "category" else "task_name"
+    data, totals = _monthly_aggregates(uid, year, month, group_field)
+    report = {"year": year, "month": month, "group_by": group_by, "data": data, "totals": totals}
+    content = _render_report(report, fmt)
+    REPORT_CACHE_DIR.mkdir(parents=True, exist_ok=True)
+    tmp = path.with_suffix(f".{os.getpid()}.{threading.get_ident()}.tmp")
+    tmp.write_bytes(content)
+    os.replace(tmp, path)
+
+    # 同じレポートの古い版は不要なので削除する
+    for old in REPORT_CACHE_DIR.glob(f"{prefix}_*.{fmt}"):
+        if old != path:
+            old.unlink(missing_ok=True)
+    return content, version
+
+@app.route("/api/report/monthly/print", methods=["GET"])
+@require_firebase_auth
+def api_report_monthly_print():
+    uid = request.firebase_uid
+
+    year = request.args.get("year", type=int) or datetime.now().year
+    month = request.args.get("month", type=int) or datetime.now().month
+    group_by = request.args.get("group_by", "category")  # category / project
+    fmt = request.args.get("format", "html")  # html / pdf
+
+    if not (1 <= month <= 12):
+        return jsonify({"error": "月は1-12の範囲で指定してください"}), 400
+    if group_by not in ("category", "project"):
+        return jsonify({"error": "group_byはcategoryまたはprojectを指定してください"}), 400
+    if fmt not in ("html", "pdf"):
+        return jsonify({"error": "formatはhtmlまたはpdfを指定してください"}), 400
+
+    try:
+        content, version = _cached_report(uid, year, month, group_by, fmt)
+    except ImportError:
+        return jsonify({"error": "PDF出力にはweasyprintのインストールが必要です"}), 501
+
+    resp = make_response(content)
+    if fmt == "pdf":
+        resp.mimetype = "application/pdf"
+        resp.headers["Content-Disposition"] = f"inline; filename=report_{year}_{month:02d}.pdf"
+    else:
+        resp.mimetype = "text/html"
+    resp.headers["Cache-Control"] = "private, no-cache"
+    resp.set_etag(version)
+    return resp.make_conditional(request)
+
 @app.route("/health")
 def health_check():
     try:
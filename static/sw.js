@@ -0,0 +1,96 @@
+// TaskBridge Service Worker
+// アプリシェルをキャッシュし、オフラインでも画面を開けるようにする。
+// /api/ へのリクエストはここでは扱わない（ページ側で IndexedDB にキャッシュ・キューする）。
+
+const CACHE_NAME = "taskbridge-shell-v1";
+const SHELL_URLS = [
+  "/",
+  "/static/style.css",
+  "/static/taskbridge-logo.png",
+  "https://www.gstatic.com/firebasejs/10.8.0/firebase-app.js",
+  "https://www.gstatic.com/firebasejs/10.8.0/firebase-auth.js",
+];
+
+self.addEventListener("install", (event) => {
+  event.waitUntil(
+    caches.open(CACHE_NAME).then((cache) => cache.addAll(SHELL_URLS)),
+  );
+  self.skipWaiting();
+});
+
+self.addEventListener("activate", (event) => {
+  event.waitUntil(
+    caches
+      .keys()
+      .then((keys) =>
+        Promise.all(
+          keys.filter((k) => k !== CACHE_NAME).map((k) => caches.delete(k)),
+        ),
+      )
+      .then(() => self.clients.claim()),
+  );
+});
+
+self.addEventListener("fetch", (event) => {
+  const req = event.request;
+  if (req.method !== "GET") return;
+
+  const url = new URL(req.url);
+  if (url.origin === self.location.origin && url.pathname.startsWith("/api/")) {
+    return;
+  }
+
+  // 画面本体はネットワーク優先（更新を反映）、失敗時はキャッシュ
+  if (req.mode === "navigate") {
+    event.respondWith(
+      fetch(req)
+        .then((res) => {
+          // アプリシェルとして保存するのは "/" の正常なレスポンスだけ
+          if (res.ok && url.pathname === "/") {
+            const copy = res.clone();
+            caches.open(CACHE_NAME).then((cache) => cache.put("/", copy));
+          }
+          return res;
+        })
+        .catch(() => caches.match("/")),
+    );
+    return;
+  }
+
+  // 同一オリジンの静的ファイルは stale-while-revalidate（更新は次回の表示から反映）
+  if (url.origin === self.location.origin) {
+    event.respondWith(
+      caches.open(CACHE_NAME).then((cache) =>
+        cache.match(req).then((cached) => {
+          const network = fetch(req)
+            .then((res) => {
+              if (res.ok) cache.put(req, res.clone());
+              return res;
+            })
+            .catch((e) => cached || Promise.reject(e));
+          if (cached) {
+            event.waitUntil(network);
+            return cached;
+          }
+          return network;
+        }),
+      ),
+    );
+    return;
+  }
+
+  // Firebase SDK（URLにバージョンを含む）はキャッシュ優先
+  event.respondWith(
+    caches.match(req).then(
+      (cached) =>
+        cached ||
+        fetch(req).then((res) => {
+          if (res.ok) {
+            const copy = res.clone();
+            caches.open(CACHE_NAME).then((cache) => cache.put(req, copy));
+          }
+          return res;
+        }),
+    ),
+  );
+});